@@ -109,20 +109,16 @@ def get_model_grad_vec(model):
 def update_grad(model, grad_vec):
     idx = 0
     for name,param in model.named_parameters():
-        arr_shape = param.grad.shape
-        size = 1
-        for i in range(len(list(arr_shape))):
-            size *= arr_shape[i]
+        arr_shape = param.shape
+        size = param.numel()
         param.grad.data = grad_vec[idx:idx+size].reshape(arr_shape)
         idx += size
 
 def update_param(model, param_vec):
     idx = 0
     for name,param in model.named_parameters():
-        arr_shape = param.data.shape
-        size = 1
-        for i in range(len(list(arr_shape))):
-            size *= arr_shape[i]
+        arr_shape = param.shape
+        size = param.numel()
         param.data = param_vec[idx:idx+size].reshape(arr_shape)
         idx += size
 
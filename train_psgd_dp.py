@@ -6,33 +6,31 @@ import time
 import torch
 import torch.nn as nn
 import torch.nn.parallel
+import torch.distributed as dist
 import torch.backends.cudnn as cudnn
 import torch.optim as optim
 import torch.utils.data
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 
-from sklearn.decomposition import PCA
 import matplotlib.pyplot as plt
 import numpy as np
 from numpy import linalg as LA
 import pickle
 import random
 import resnet
-from utils import get_datasets, get_model, get_sigma
+from utils import get_datasets, get_model, get_sigma, loader_kwargs
 
 
 #package for computing individual gradients
-from backpack import backpack, extend
-from backpack.extensions import BatchGrad
+from torch.func import functional_call, vmap
 
 def set_seed(seed=233): 
     random.seed(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
 
 print ('P-SGD')
 
@@ -60,7 +58,9 @@ parser.add_argument('-e', '--evaluate', dest='evaluate', action='store_true',
 parser.add_argument('--pretrained', dest='pretrained', action='store_true',
                     help='use pre-trained model')
 parser.add_argument('--half', dest='half', action='store_true',
-                    help='use half-precision(16-bit) ')
+                    help='use mixed precision (16-bit autocast) ')
+parser.add_argument('--loss-scale', dest='loss_scale', default=1024., type=float,
+                    help='static loss scale for the per-sample gradients under --half (overflowing samples are zeroed)')
 parser.add_argument('--save-dir', dest='save_dir',
                     help='The directory used to save the trained models',
                     default='save_temp', type=str)
@@ -92,158 +92,243 @@ parser.add_argument('--smalldatasets', default=None, type=float, dest='smalldata
 parser.add_argument('--eps', default=8., type=float, help='privacy parameter epsilon')
 parser.add_argument('--delta', default=1e-5, type=float, help='desired delta')
 parser.add_argument('--clip', default=5, type=float, help="clipping the threshold for low dimensional gradient")
+parser.add_argument('--approx-error', dest='approx_error', action='store_true',
+                    help='every 10 print intervals, print how well the subspace reconstructs the mean gradient')
+parser.add_argument('--micro-batches', dest='micro_batches', default=1, type=int,
+                    help='number of micro-batches the per-sample gradients of a batch are computed in')
 
 args = parser.parse_args()
+if args.micro_batches < 1:
+    parser.error('--micro-batches must be at least 1')
+# Bind this torchrun rank to its GPU before any module-level CUDA work (e.g. Bk below),
+# otherwise every rank opens a context on GPU 0
+args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+if 'LOCAL_RANK' in os.environ:
+    torch.cuda.set_device(args.local_rank)
 set_seed(args.randomseed)
 best_prec1 = 0
 P = None
+P_T = None
+params = None
+noise_pool, noise_step = None, 0
+flat_grad, grad_views = None, None
 train_acc, test_acc, train_loss, test_loss = [], [], [], []
 
 def get_model_param_vec(model):
     """
     Return model parameters as a vector
     """
-    vec = []
-    for name,param in model.named_parameters():
-        vec.append(param.detach().cpu().numpy().reshape(-1))
-    return np.concatenate(vec, 0)
+    return _flatten_dense_tensors([param.detach() for param in model.parameters()])
 
 def get_model_grad_vec(model):
     # Return the model grad as a vector
 
-    vec = []
-    for name,param in model.named_parameters():
-        vec.append(param.grad.detach().reshape(-1))
-    return torch.cat(vec, 0)
-
-def get_model_grad_vec_batch(model):
-    # Return the model grad as a vector
-
-    vec = []
-    for name,param in model.named_parameters():
-        vec.append(param.grad_batch.reshape(param.grad_batch.shape[0], -1))
-    return torch.cat(vec, 1)
+    return _flatten_dense_tensors([param.grad.detach() for param in model.parameters()])
+
+def get_model_grad_vec_batch(model, criterion, input, target, loss_scale=1., zero_nonfinite=False):
+    # Return the per-sample grads as a [batch, n_params] matrix, along with the per-sample
+    # outputs and losses of the same forward pass and the number of zeroed rows
+    # The loss is scaled by loss_scale to keep fp16 grads from underflowing, then unscaled.
+    # With zero_nonfinite, a sample whose fp16 backward overflows gets an all-zero row: clipping
+    # an inf row would yield NaN and poison the update, while a zero row keeps the sensitivity
+    # bounded by clip and simply drops that sample from the step
+
+    module = model.module
+    named_params = {name: param.detach() for name,param in module.named_parameters()}
+    buffers = {name: buffer.detach() for name,buffer in module.named_buffers()}
+
+    def compute_loss(named_params, buffers, x, y):
+        output = functional_call(module, (named_params, buffers), (x.unsqueeze(0),))
+        loss = criterion(output, y.unsqueeze(0))
+        return loss * loss_scale, (output.squeeze(0).detach(), loss.detach())
+
+    grads, (output, loss) = vmap(torch.func.grad(compute_loss, has_aux=True), in_dims=(None, None, 0, 0))(named_params, buffers, input, target)
+    grad_batch = torch.cat([g.reshape(g.shape[0], -1) for g in grads.values()], 1)
+    if loss_scale != 1.:
+        grad_batch.div_(loss_scale)
+    n_zeroed = 0
+    if zero_nonfinite:
+        nonfinite = ~torch.isfinite(grad_batch).all(dim=1, keepdim=True)
+        grad_batch.masked_fill_(nonfinite, 0.)
+        n_zeroed = torch.sum(nonfinite)
+    return grad_batch, output, loss, n_zeroed
 
 def update_grad(model, grad_vec):
-    idx = 0
-    for name,param in model.named_parameters():
-        arr_shape = param.grad.shape
-        size = 1
-        for i in range(len(list(arr_shape))):
-            size *= arr_shape[i]
-        param.grad.data = grad_vec[idx:idx+size].reshape(arr_shape)
-        idx += size
+    model_params = list(model.parameters())
+    for param, param_grad in zip(model_params, _unflatten_dense_tensors(grad_vec, model_params)):
+        if param.grad is None:
+            param.grad = torch.empty_like(param)
+        param.grad.detach().copy_(param_grad)
 
 def update_param(model, param_vec):
-    idx = 0
-    for name,param in model.named_parameters():
-        arr_shape = param.data.shape
-        size = 1
-        for i in range(len(list(arr_shape))):
-            size *= arr_shape[i]
-        param.data = param_vec[idx:idx+size].reshape(arr_shape)
-        idx += size
+    model_params = list(model.parameters())
+    for param, value in zip(model_params, _unflatten_dense_tensors(param_vec, model_params)):
+        param.detach().copy_(value)
 
 def main():
 
-    global args, best_prec1, Bk, p0, P
+    global args, best_prec1, Bk, p0, P, P_T, params, noise_pool, flat_grad, grad_views
+
+    # Launched through torchrun --nproc_per_node=N: one process per GPU
+    args.distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    args.rank, args.world_size = 0, 1
+    if args.distributed:
+        dist.init_process_group(backend='nccl')
+        args.rank, args.world_size = dist.get_rank(), dist.get_world_size()
 
     # Check the save_dir exists or not
-    print (args.save_dir)
-    if not os.path.exists(args.save_dir):
-        os.makedirs(args.save_dir)
+    if args.rank == 0:
+        print (args.save_dir)
+    os.makedirs(args.save_dir, exist_ok=True)
     
     # Define model
-    model = torch.nn.DataParallel(get_model(args))
+    if args.distributed:
+        # No DDP: the per-sample pass runs on model.module, so DDP's reducer would never fire.
+        # Every rank loads the same params_start checkpoint and the all_reduce of the k-dim
+        # sum in P_SGD_DP is the only gradient sync; the single-device DataParallel wrapper
+        # just keeps .module and the checkpoints' 'module.' keys
+        model = torch.nn.DataParallel(get_model(args), device_ids=[args.local_rank])
+    else:
+        model = torch.nn.DataParallel(get_model(args))
     model.cuda()
-    model = extend(model)
 
-    # Load sampled model parameters
-    print ('params: from', args.params_start, 'to', args.params_end)
-    W = []
-    for i in range(args.params_start, args.params_end):
-        ############################################################################
-        # if i % 2 != 0: continue
-
-        model.load_state_dict(torch.load(os.path.join(args.save_dir,  str(i) +  '.pt')))
-        W.append(get_model_param_vec(model))
-    W = np.array(W)
-    print ('W:', W.shape)
-
-    # Obtain base variables through PCA
-    pca = PCA(n_components=args.n_components)
-    pca.fit_transform(W)
-    P = np.array(pca.components_)
-    print ('ratio:', pca.explained_variance_ratio_)
-    print ('P:', P.shape)
-
-    P = torch.from_numpy(P).cuda()
+    # Cache the parameter list once; the flatten/unflatten helpers reuse it every step
+    params = [param for name,param in model.named_parameters()]
+
+    # Load sampled model parameters, cached as a single [N, D] array after the first run
+    if args.rank == 0:
+        print ('params: from', args.params_start, 'to', args.params_end)
+    W_path = os.path.join(args.save_dir, 'W_' + str(args.params_start) + '_' + str(args.params_end) + '.npy')
+    W_shape = (args.params_end - args.params_start, sum(param.numel() for param in params))
+    ckpt_paths = [os.path.join(args.save_dir,  str(i) +  '.pt') for i in range(args.params_start, args.params_end)]
+    # Rebuild the cache if it is missing, was built for another arch, or predates any checkpoint
+    # still on disk; pruned checkpoints are fine once cached (delete the file to force a rebuild)
+    if args.rank == 0 and (not os.path.exists(W_path)
+                           or np.load(W_path, mmap_mode='r').shape != W_shape
+                           or any(os.path.getmtime(path) > os.path.getmtime(W_path)
+                                  for path in ckpt_paths if os.path.exists(path))):
+        W = np.lib.format.open_memmap(W_path + '.tmp', mode='w+', dtype=np.float32, shape=W_shape)
+        param_buf = torch.empty(W.shape[1], pin_memory=True)
+        for i, path in enumerate(ckpt_paths):
+            model.load_state_dict(torch.load(path, map_location='cuda'))
+            # One bulk D2H copy into pinned memory, read through a zero-copy numpy view
+            param_buf.copy_(get_model_param_vec(model))
+            W[i] = param_buf.numpy()
+        W.flush()
+        del W, param_buf
+        os.replace(W_path + '.tmp', W_path)
+    # Obtain base variables through exact PCA on rank 0 and broadcast them: the replicas are
+    # never re-synced, so every rank must project onto bitwise identical bases
+    P = torch.empty((args.n_components, W_shape[1]), device='cuda')
+    if args.rank == 0:
+        # Copy-on-write memory map: pages stream from the file straight to the GPU copy
+        W = torch.from_numpy(np.load(W_path, mmap_mode='c')).cuda()
+        print ('W:', tuple(W.shape))
+
+        # N is small, so the thin SVD of the centered samples is cheap
+        W -= torch.mean(W, dim=0)
+        U, S, Vh = torch.linalg.svd(W, full_matrices=False)
+        P.copy_(Vh[:args.n_components])
+        print ('ratio:', (S[:args.n_components] ** 2 / torch.sum(S ** 2)).cpu().numpy())
+        print ('P:', tuple(P.shape))
+        del W, U, S, Vh
+    if args.distributed:
+        dist.broadcast(P, 0)
+
+    # Ampere+ runs the memory-bound projections as bf16 GEMMs with fp32 accumulation;
+    # all ranks must agree, so the oldest GPU decides
+    capability = torch.tensor(torch.cuda.get_device_capability()[0], device='cuda')
+    if args.distributed:
+        dist.all_reduce(capability, op=dist.ReduceOp.MIN)
+    if capability.item() >= 8:
+        P = P.to(torch.bfloat16)
+    # Both GEMM operands stay contiguous so cuBLAS never transposes P per step
+    P_T = P.T.contiguous()
+
+    # Noise for 1024 steps is drawn in one kernel and consumed one row per step
+    noise_pool = torch.empty(1024, args.n_components, device='cuda')
+    flat_grad = torch.empty(P.shape[1], device='cuda')
+    grad_views = _unflatten_dense_tensors(flat_grad, params)
 
     # Resume from params_start
-    model.load_state_dict(torch.load(os.path.join(args.save_dir,  str(args.params_start) +  '.pt')))
+    model.load_state_dict(torch.load(os.path.join(args.save_dir,  str(args.params_start) +  '.pt'), map_location='cuda'))
 
-    # Prepare Dataloader
+    # Prepare Dataloader; rank 0 downloads / builds the dataset files first, the other
+    # ranks wait so they never race on ../data
+    if args.distributed and args.rank != 0:
+        dist.barrier()
     train_loader, val_loader = get_datasets(args)
+    if args.distributed and args.rank == 0:
+        dist.barrier()
+    if args.distributed:
+        # Shard the training set across ranks, each rank keeps the per-rank batch size.
+        # drop_last keeps the sampler from padding with repeated examples, which could put
+        # one example in two shards of a step and double its contribution past clip
+        train_loader = torch.utils.data.DataLoader(
+            train_loader.dataset, batch_size=args.batch_size,
+            sampler=torch.utils.data.distributed.DistributedSampler(train_loader.dataset, drop_last=True),
+            **loader_kwargs(args))
     
     # Define loss function (criterion) and optimizer
     criterion = nn.CrossEntropyLoss(reduction='sum').cuda()
-    criterion = extend(criterion)
-    if args.half:
-        model.half()
-        criterion.half()
 
     cudnn.benchmark = True
+    cudnn.allow_tf32 = True
+    torch.backends.cuda.matmul.allow_tf32 = True
 
     optimizer = optim.SGD(model.parameters(), lr=args.lr, momentum=0.9)
     lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
                                                         milestones=[30, 50], last_epoch=args.start_epoch - 1)
 
     if args.evaluate:
-        validate(val_loader, model, criterion)
+        if args.rank == 0:
+            validate(val_loader, model, criterion)
         return
 
     # DP
-    print('==> Computing noise scale for privacy budget ({:.1f}, {:f})-DP'.format(args.eps, args.delta))
+    if args.rank == 0:
+        print('==> Computing noise scale for privacy budget ({:.1f}, {:f})-DP'.format(args.eps, args.delta))
     sampling_prob = 1 / len(train_loader)
     total_steps = int(args.epochs / sampling_prob)
     sigma, eps = get_sigma(sampling_prob, total_steps, args.eps, args.delta, rgp=False)
     noise_multiplier = sigma
-    print("noise scale for low-dimensional gradient: ", sigma, "\n privacy guarantee: ", eps)
-
-
-
-
-    
-
-    print ('Train:', (args.start_epoch, args.epochs))
+    # Noise is added to the sum of clipped embeddings, so its scale does not depend on the batch size
+    noise_std = noise_multiplier * args.clip
+    if args.rank == 0:
+        print("noise scale for low-dimensional gradient: ", sigma, "\n privacy guarantee: ", eps)
+        print ('Train:', (args.start_epoch, args.epochs))
     end = time.time()
     p0 = get_model_param_vec(model)
     for epoch in range(args.start_epoch, args.epochs):
+        if args.distributed:
+            train_loader.sampler.set_epoch(epoch)
         # Train for one epoch
-        train(train_loader, model, criterion, optimizer, epoch, noise_multiplier, args.clip)
+        train(train_loader, model, criterion, optimizer, epoch, noise_std, args.clip)
         # Bk = torch.eye(args.n_components).cuda()
         lr_scheduler.step()
 
-        # Evaluate on validation set
-        prec1 = validate(val_loader, model, criterion)
-
-        # Remember best prec@1 and save checkpoint
-        is_best = prec1 > best_prec1
-        best_prec1 = max(prec1, best_prec1)
+        # Evaluate on validation set, replicas are identical so rank 0 alone is enough
+        if args.rank == 0:
+            prec1 = validate(val_loader, model, criterion)
 
-    print ('total time:', time.time() - end)
-    print ('train loss: ', train_loss)
-    print ('train acc: ', train_acc)
-    print ('test loss: ', test_loss)
-    print ('test acc: ', test_acc)      
-    print ('best_prec1:', best_prec1)
+            # Remember best prec@1 and save checkpoint
+            is_best = prec1 > best_prec1
+            best_prec1 = max(prec1, best_prec1)
 
     # torch.save(model.state_dict(), 'PBFGS.pt',_use_new_zipfile_serialization=False)  
-    torch.save(model.state_dict(), 'PSGD.pt')  
+    if args.rank == 0:
+        print ('total time:', time.time() - end)
+        print ('train loss: ', train_loss)
+        print ('train acc: ', train_acc)
+        print ('test loss: ', test_loss)
+        print ('test acc: ', test_acc)      
+        print ('best_prec1:', best_prec1)
+
+        torch.save(model.state_dict(), 'PSGD.pt')
 
 running_grad = 0
 
-def train(train_loader, model, criterion, optimizer, epoch, noise_multiplier, clip):
+def train(train_loader, model, criterion, optimizer, epoch, noise_std, clip):
     # Run one train epoch
 
     global P, W, iters, T, train_loss, train_acc, search_times, running_grad, p0
@@ -263,24 +348,15 @@ def train(train_loader, model, criterion, optimizer, epoch, noise_multiplier, cl
         data_time.update(time.time() - end)
 
         # Load batch data to cuda
-        target = target.cuda()
-        input_var = input.cuda()
+        target = target.cuda(non_blocking=True)
+        input_var = input.cuda(non_blocking=True)
         target_var = target
-        if args.half:
-            input_var = input_var.half()
-
-        # Compute output
-        output = model(input_var)
-        loss = criterion(output, target_var)
-
-        # Compute gradient and do SGD step
-        optimizer.zero_grad()
-        with backpack(BatchGrad()):
-            loss.backward()
 
-        # Do P_plus_BFGS update
-        gk = get_model_grad_vec_batch(model)
-        org_norms_stat, clipped_norms_stat = P_SGD_DP(model, optimizer, gk, loss.item(), input_var, target_var, noise_multiplier=noise_multiplier, clip=clip)
+        # Compute output and per-sample gradients in one pass, and do P_plus_BFGS update
+        optimizer.zero_grad(set_to_none=True)
+        log = args.rank == 0 and (i % args.print_freq == 0 or i == len(train_loader)-1)
+        diagnose = args.approx_error and args.rank == 0 and i % (args.print_freq * 10) == 0
+        output, loss, org_norms_stat, clipped_norms_stat, n_zeroed = P_SGD_DP(model, optimizer, criterion, input_var, target_var, noise_std=noise_std, clip=clip, log=log, diagnose=diagnose)
 
         # Measure accuracy and record loss
         prec1 = accuracy(output.data, target)[0]
@@ -291,7 +367,7 @@ def train(train_loader, model, criterion, optimizer, epoch, noise_multiplier, cl
         batch_time.update(time.time() - end)
         end = time.time()
         
-        if i % args.print_freq == 0 or i == len(train_loader)-1:
+        if log:
             print('Epoch: [{0}][{1}/{2}]\t'
                   'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                   'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'
@@ -302,6 +378,8 @@ def train(train_loader, model, criterion, optimizer, epoch, noise_multiplier, cl
             print("low dimensional original norms: mean: {:.2f} max: {:.2f}, median: {:2f}".format(org_norms_stat[0], org_norms_stat[1], org_norms_stat[2]))
 
             print("low dimensional clipped norms: mean: {:.2f} max: {:.2f}, median: {:2f}".format(clipped_norms_stat[0], clipped_norms_stat[1], clipped_norms_stat[2]))
+            if args.half:
+                print("samples zeroed after fp16 overflow: {}".format(n_zeroed))
 
 
     train_loss.append(losses.avg)
@@ -345,69 +423,100 @@ def P_SGD(model, optimizer, grad, oldf, X, y):
 
 
 def clip_column(tsr, clip=1.0, inplace=True):
+    # Scale every row whose l2 norm exceeds clip back onto the clip ball
+    norms = torch.linalg.vector_norm(tsr, dim=1, keepdim=True)
+    scale = torch.clamp(norms / clip, min=1.0)
     if(inplace):
-        inplace_clipping(tsr, torch.tensor(clip).cuda())
+        tsr.div_(scale)
     else:
-        norms = torch.norm(tsr, dim=1)
-
-        scale = torch.clamp(clip/norms, max=1.0)
-        return tsr * scale.view(-1, 1) 
-
-@torch.jit.script
-def inplace_clipping(matrix, clip):
-    n, m = matrix.shape
-    for i in range(n):
-        # Normalize the i'th row
-        col = matrix[i:i+1, :]
-        col_norm = torch.sqrt(torch.sum(col ** 2))     
-        if(col_norm > clip):
-            col /= (col_norm/clip)
-
-def P_SGD_DP(model, optimizer, grad, oldf, X, y, noise_multiplier, clip):
-    # P_plus_BFGS algorithm
-
-    global rho, sigma, Bk, sk, gk_last, grad_res_momentum, gamma, alpha, search_times
-
-    selected_bases = P.T
-    selected_bases_T = P
-
-    embedding = torch.matmul(grad, selected_bases)
+        return tsr / scale
 
+# Default mode: CUDA graphs would copy the whole per-sample gradient matrix into a
+# static input buffer on every call and re-record for every ragged chunk size
+@torch.compile
+def _dp_step(grad, selected_bases, clip):
+    # Project and clip the per-sample gradients and sum them in one compiled graph
 
-    cur_approx = torch.matmul(torch.mean(embedding, dim=0).view(1, -1), selected_bases_T).view(-1)
-    cur_target = torch.mean(grad, dim=0)
-    cur_error = torch.sum(torch.square(cur_approx - cur_target)) / torch.sum(torch.square(cur_target))
-
-    embedding_norms = torch.norm(embedding, dim=1)
-
-    org_norms_stat = [torch.mean(embedding_norms).item(), torch.max(embedding_norms).item(), torch.median(embedding_norms).item()]
-
-    # print("approx error: {:.2f}".format(100 * cur_error.item()))
+    embedding = torch.matmul(grad.to(selected_bases.dtype), selected_bases).float()
+    embedding_norms = torch.linalg.vector_norm(embedding, dim=1)
 
     clipped_embedding = clip_column(embedding, clip=clip, inplace=False)
+    return torch.sum(clipped_embedding, dim=0), embedding_norms
 
-    clipped_norms = torch.norm(clipped_embedding, dim=1)
-
-    clipped_norms_stat =  [torch.mean(clipped_norms).item(), torch.max(clipped_norms).item(), torch.median(clipped_norms).item()]
-    # print('average norm of clipped embedding: ', torch.mean(norms).item(), 'max norm: ', torch.max(norms).item(), 'median norm: ', torch.median(norms).item())
-
-    avg_clipped_embedding = torch.sum(clipped_embedding, dim=0) / embedding.shape[0]
-
-    clipped_theta = avg_clipped_embedding.view(-1)
-
-    theta_noise = torch.normal(0, noise_multiplier * clip / embedding.shape[0], size=clipped_theta.shape, device= clipped_theta.device)
+def P_SGD_DP(model, optimizer, criterion, X, y, noise_std, clip, log=False, diagnose=False):
+    # P_plus_BFGS algorithm
 
-    clipped_theta += theta_noise
+    global rho, sigma, Bk, sk, gk_last, grad_res_momentum, gamma, alpha, search_times, noise_step
 
-    noisy_grad = torch.matmul(clipped_theta.view(1, -1), selected_bases_T).reshape(-1)
+    selected_bases = P_T
+    selected_bases_T = P
 
-    
-    # print(noisy_grad.shape)
-    # Update the model grad and do a step
-    update_grad(model, noisy_grad)
+    # Accumulate the clipped embeddings over micro-batches, so only one
+    # micro-batch of per-sample gradients is alive at a time
+    clipped_theta = torch.zeros(args.n_components, device=X.device)
+    embedding_norms = torch.empty(X.shape[0], device=X.device) if log else None
+    grad_sum = 0
+    start = 0
+    outputs, loss, n_zeroed = [], 0, 0
+    for X_chunk, y_chunk in zip(X.chunk(args.micro_batches), y.chunk(args.micro_batches)):
+        with torch.autocast('cuda', dtype=torch.float16, enabled=args.half):
+            grad, chunk_output, chunk_loss, chunk_zeroed = get_model_grad_vec_batch(model, criterion, X_chunk, y_chunk,
+                                                                                    loss_scale=args.loss_scale if args.half else 1.,
+                                                                                    zero_nonfinite=args.half)
+        outputs.append(chunk_output)
+        loss = loss + torch.sum(chunk_loss)
+        n_zeroed = n_zeroed + chunk_zeroed
+
+        clipped_sum, chunk_norms = _dp_step(grad, selected_bases, clip)
+        clipped_theta += clipped_sum
+        if log:
+            embedding_norms[start:start+X_chunk.shape[0]] = chunk_norms
+        if diagnose:
+            grad_sum = grad_sum + torch.sum(grad, dim=0)
+        start += X_chunk.shape[0]
+        del grad
+
+    # Noise the global sum of clipped embeddings once, on rank 0, then sum across ranks;
+    # every row of the pool is used by exactly one step before it is redrawn
+    if args.rank == 0:
+        if noise_step % noise_pool.shape[0] == 0:
+            noise_pool.normal_(0, noise_std)
+        clipped_theta.add_(noise_pool[noise_step % noise_pool.shape[0]])
+        noise_step += 1
+    if args.distributed:
+        dist.all_reduce(clipped_theta)
+    clipped_theta.div_(X.shape[0] * args.world_size)
+
+    org_norms_stat, clipped_norms_stat = None, None
+    if log:
+        # The clipped norms are exactly the original norms capped at clip
+        clipped_norms = torch.clamp(embedding_norms, max=clip)
+
+        # Gather all statistics, including the overflow count, in a single device-to-host copy
+        norms_stat = torch.stack([torch.mean(embedding_norms), torch.max(embedding_norms), torch.median(embedding_norms),
+                                  torch.mean(clipped_norms), torch.max(clipped_norms), torch.median(clipped_norms),
+                                  torch.as_tensor(n_zeroed, dtype=embedding_norms.dtype, device=embedding_norms.device)]).tolist()
+        org_norms_stat, clipped_norms_stat, n_zeroed = norms_stat[:3], norms_stat[3:6], int(norms_stat[6])
+
+    if diagnose:
+        # Relative error of reconstructing the mean gradient from the subspace
+        cur_target = grad_sum / X.shape[0]
+        cur_embedding = torch.matmul(cur_target.to(selected_bases.dtype), selected_bases)
+        cur_approx = torch.matmul(cur_embedding, selected_bases_T).float()
+        cur_error = torch.sum(torch.square(cur_approx - cur_target)) / torch.sum(torch.square(cur_target))
+        print("approx error (rank 0 shard): {:.2f}".format(100 * cur_error.item()))
+
+    # Project back into the persistent flat gradient, whose views are the model grads
+    if selected_bases_T.dtype == flat_grad.dtype:
+        torch.matmul(clipped_theta.view(1, -1), selected_bases_T, out=flat_grad.view(1, -1))
+    else:
+        # Reduced-precision bases: reconstruct in their dtype and upcast into the fp32 grads
+        flat_grad.copy_(torch.matmul(clipped_theta.to(selected_bases_T.dtype), selected_bases_T))
+    for param, param_grad in zip(params, grad_views):
+        param.grad = param_grad
     optimizer.step()
 
-    return org_norms_stat, clipped_norms_stat
+    return torch.cat(outputs), loss, org_norms_stat, clipped_norms_stat, n_zeroed
 
 def validate(val_loader, model, criterion):
     # Run evaluation
@@ -424,16 +533,14 @@ def validate(val_loader, model, criterion):
     end = time.time()
     with torch.no_grad():
         for i, (input, target) in enumerate(val_loader):
-            target = target.cuda()
-            input_var = input.cuda()
-            target_var = target.cuda()
-
-            if args.half:
-                input_var = input_var.half()
+            target = target.cuda(non_blocking=True)
+            input_var = input.cuda(non_blocking=True)
+            target_var = target
 
             # Compute output
-            output = model(input_var)
-            loss = criterion(output, target_var)
+            with torch.autocast('cuda', dtype=torch.float16, enabled=args.half):
+                output = model(input_var)
+                loss = criterion(output, target_var)
 
             output = output.float()
             loss = loss.float()
@@ -447,7 +554,7 @@ def validate(val_loader, model, criterion):
             batch_time.update(time.time() - end)
             end = time.time()
 
-            if i % args.print_freq == 0:
+            if args.rank == 0 and i % args.print_freq == 0:
                 print('Test: [{0}/{1}]\t'
                       'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                       'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
@@ -455,8 +562,9 @@ def validate(val_loader, model, criterion):
                           i, len(val_loader), batch_time=batch_time, loss=losses,
                           top1=top1))
 
-    print(' * Prec@1 {top1.avg:.3f}'
-          .format(top1=top1))
+    if args.rank == 0:
+        print(' * Prec@1 {top1.avg:.3f}'
+              .format(top1=top1))
 
     # Store the test loss and test accuracy
     test_loss.append(losses.avg)
@@ -1,4 +1,5 @@
 import argparse
+import builtins
 import os
 import shutil
 import time
@@ -84,7 +85,17 @@ def pgd_linf(model, X, y, epsilon=8./255, alpha=0.01, num_iter=7, randomize=True
         delta.grad.zero_()
     return delta.detach()
 
+def loader_kwargs(args):
+    # Pinned memory plus persistent, prefetching workers so H2D copies overlap compute
+    kwargs = dict(num_workers=args.workers, pin_memory=True)
+    if args.workers > 0:
+        kwargs.update(persistent_workers=True, prefetch_factor=4)
+    return kwargs
+
 def get_datasets(args):
+    # Only the first process of a distributed run reports on the datasets
+    print = builtins.print if getattr(args, 'rank', 0) == 0 else (lambda *objects, **kwargs: None)
+
     if args.datasets == 'MNIST':
         print ('normal dataset!')
         mnist_train = datasets.MNIST("../data", train=True, download=True, transform=transforms.ToTensor())
@@ -120,7 +131,7 @@ def get_datasets(args):
             train_loader = torch.utils.data.DataLoader(
                 trainset,
                 batch_size=args.batch_size, shuffle=True,
-                num_workers=args.workers, pin_memory=True)
+                **loader_kwargs(args))
 
         elif args.smalldatasets:
             percent = args.smalldatasets
@@ -152,7 +163,7 @@ def get_datasets(args):
             train_loader = torch.utils.data.DataLoader(
                 trainset,
                 batch_size=args.batch_size, shuffle=True,
-                num_workers=args.workers, pin_memory=True)
+                **loader_kwargs(args))
             print ('dataset size: ', len(train_loader.dataset))
         
         else:
@@ -165,7 +176,7 @@ def get_datasets(args):
                     normalize,
                 ]), download=True),
                 batch_size=args.batch_size, shuffle=True,
-                num_workers=args.workers, pin_memory=True)
+                **loader_kwargs(args))
 
         val_loader = torch.utils.data.DataLoader(
             datasets.CIFAR10(root='../data', train=False, transform=transforms.Compose([
@@ -173,7 +184,7 @@ def get_datasets(args):
                 normalize,
             ])),
             batch_size=128, shuffle=False,
-            num_workers=args.workers, pin_memory=True)
+            **loader_kwargs(args))
 
     elif args.datasets == 'CIFAR100':
         normalize = transforms.Normalize(mean=[0.5070751592371323, 0.48654887331495095, 0.4409178433670343],
@@ -213,7 +224,7 @@ def get_datasets(args):
             train_loader = torch.utils.data.DataLoader(
                 trainset,
                 batch_size=args.batch_size, shuffle=True,
-                num_workers=args.workers, pin_memory=True)
+                **loader_kwargs(args))
 
         elif args.smalldatasets:
             percent = args.smalldatasets
@@ -245,7 +256,7 @@ def get_datasets(args):
             train_loader = torch.utils.data.DataLoader(
                 trainset,
                 batch_size=args.batch_size, shuffle=True,
-                num_workers=args.workers, pin_memory=True)
+                **loader_kwargs(args))
             print ('dataset size: ', len(train_loader.dataset))
         
         else:
@@ -258,7 +269,7 @@ def get_datasets(args):
                     normalize,
                 ]), download=True),
                 batch_size=args.batch_size, shuffle=True,
-                num_workers=args.workers, pin_memory=True)
+                **loader_kwargs(args))
 
         val_loader = torch.utils.data.DataLoader(
             datasets.CIFAR100(root='../data', train=False, transform=transforms.Compose([
@@ -266,7 +277,7 @@ def get_datasets(args):
                 normalize,
             ])),
             batch_size=128, shuffle=False,
-            num_workers=args.workers, pin_memory=True)
+            **loader_kwargs(args))
 
     elif args.datasets == 'ImageNet':
         traindir = os.path.join('/home/datasets/ILSVRC2012/', 'train')
@@ -285,7 +296,7 @@ def get_datasets(args):
 
         train_loader = torch.utils.data.DataLoader(
             train_dataset, batch_size=args.batch_size, shuffle=True,
-            num_workers=args.workers, pin_memory=True)
+            **loader_kwargs(args))
 
         val_loader = torch.utils.data.DataLoader(
             datasets.ImageFolder(valdir, transforms.Compose([
@@ -295,7 +306,7 @@ def get_datasets(args):
                 normalize,
             ])),
             batch_size=args.batch_size, shuffle=False,
-            num_workers=args.workers)
+            **loader_kwargs(args))
     
     return train_loader, val_loader
 